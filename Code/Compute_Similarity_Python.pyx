@@ -13,22 +13,20 @@ import scipy.sparse as sps
 
 
 def check_matrix(X, format='csc', dtype=np.float32):
-    if format == 'csc' and not isinstance(X, sps.csc_matrix):
-        return X.tocsc().astype(dtype)
-    elif format == 'csr' and not isinstance(X, sps.csr_matrix):
-        return X.tocsr().astype(dtype)
-    elif format == 'coo' and not isinstance(X, sps.coo_matrix):
-        return X.tocoo().astype(dtype)
-    elif format == 'dok' and not isinstance(X, sps.dok_matrix):
-        return X.todok().astype(dtype)
-    elif format == 'bsr' and not isinstance(X, sps.bsr_matrix):
-        return X.tobsr().astype(dtype)
-    elif format == 'dia' and not isinstance(X, sps.dia_matrix):
-        return X.todia().astype(dtype)
-    elif format == 'lil' and not isinstance(X, sps.lil_matrix):
-        return X.tolil().astype(dtype)
-    else:
-        return X.astype(dtype)
+
+    # Nothing to do, avoid a full copy of the matrix
+    if sps.issparse(X) and X.format == format and X.dtype == dtype:
+        return X
+
+    converter = {'csc': X.tocsc,
+                 'csr': X.tocsr,
+                 'coo': X.tocoo,
+                 'dok': X.todok,
+                 'bsr': X.tobsr,
+                 'dia': X.todia,
+                 'lil': X.tolil}[format]
+
+    return converter().astype(dtype, copy=False)
 
 
 
@@ -25,7 +25,7 @@ class P3alphaRecommender(SimilarityMatrixRecommender, Recommender):
     def __init__(self, URM_train):
         super(P3alphaRecommender, self).__init__()
 
-        self.URM_train = check_matrix(URM_train, format='csr', dtype=np.float32)
+        self.URM_train = check_matrix(URM_train.copy(), format='csr', dtype=np.float32)
         self.sparse_weights = True
 
 
@@ -22,7 +22,7 @@ class RP3betaRecommender(SimilarityMatrixRecommender, Recommender):
     def __init__(self, URM_train):
         super(RP3betaRecommender, self).__init__()
 
-        self.URM_train = check_matrix(URM_train, format='csr', dtype=np.float32)
+        self.URM_train = check_matrix(URM_train.copy(), format='csr', dtype=np.float32)
         self.sparse_weights = True
 
 
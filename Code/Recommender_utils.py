@@ -11,22 +11,20 @@ import time
 import os
 
 def check_matrix(X, format='csc', dtype=np.float32):
-    if format == 'csc' and not isinstance(X, sps.csc_matrix):
-        return X.tocsc().astype(dtype)
-    elif format == 'csr' and not isinstance(X, sps.csr_matrix):
-        return X.tocsr().astype(dtype)
-    elif format == 'coo' and not isinstance(X, sps.coo_matrix):
-        return X.tocoo().astype(dtype)
-    elif format == 'dok' and not isinstance(X, sps.dok_matrix):
-        return X.todok().astype(dtype)
-    elif format == 'bsr' and not isinstance(X, sps.bsr_matrix):
-        return X.tobsr().astype(dtype)
-    elif format == 'dia' and not isinstance(X, sps.dia_matrix):
-        return X.todia().astype(dtype)
-    elif format == 'lil' and not isinstance(X, sps.lil_matrix):
-        return X.tolil().astype(dtype)
-    else:
-        return X.astype(dtype)
+
+    # Nothing to do, avoid a full copy of the matrix
+    if sps.issparse(X) and X.format == format and X.dtype == dtype:
+        return X
+
+    converter = {'csc': X.tocsc,
+                 'csr': X.tocsr,
+                 'coo': X.tocoo,
+                 'dok': X.todok,
+                 'bsr': X.tobsr,
+                 'dia': X.todia,
+                 'lil': X.tolil}[format]
+
+    return converter().astype(dtype, copy=False)
 
 
 def similarityMatrixTopK(item_weights, forceSparseOutput = True, k=100, verbose = False, inplace=True):
@@ -56,15 +54,14 @@ def similarityMatrixTopK(item_weights, forceSparseOutput = True, k=100, verbose
 
     if not sparse_weights:
 
-        idx_sorted = np.argsort(item_weights, axis=0)  # sort data inside each column
-
         if inplace:
             W = item_weights
         else:
             W = item_weights.copy()
 
         # index of the items that don't belong to the top-k similar items of each column
-        not_top_k = idx_sorted[:-k, :]
+        # partitioning is enough, the order within the two groups is irrelevant
+        not_top_k = np.argpartition(item_weights, nitems-k, axis=0)[:nitems-k, :]
         # use numpy fancy indexing to zero-out the values in sim without using a for loop
         W[not_top_k, np.arange(nitems)] = 0.0
 
@@ -83,13 +80,18 @@ def similarityMatrixTopK(item_weights, forceSparseOutput = True, k=100, verbose
 
     else:
         # iterate over each column and keep only the top-k similar items
-        data, rows_indices, cols_indptr = [], [], []
-
         item_weights = check_matrix(item_weights, format='csc', dtype=np.float32)
 
-        for item_idx in range(nitems):
+        # at most k values per column, filled sequentially and trimmed at the end
+        max_nnz = min(nitems*k, item_weights.nnz)
+
+        data = np.empty(max_nnz, dtype=np.float32)
+        rows_indices = np.empty(max_nnz, dtype=np.int32)
+        cols_indptr = np.zeros(nitems+1, dtype=np.int32)
 
-            cols_indptr.append(len(data))
+        num_cells = 0
+
+        for item_idx in range(nitems):
 
             start_position = item_weights.indptr[item_idx]
             end_position = item_weights.indptr[item_idx+1]
@@ -98,18 +100,24 @@ def similarityMatrixTopK(item_weights, forceSparseOutput = True, k=100, verbose
             column_row_index = item_weights.indices[start_position:end_position]
 
             non_zero_data = column_data!=0
+            num_non_zero = np.count_nonzero(non_zero_data)
 
-            idx_sorted = np.argsort(column_data[non_zero_data])  # sort by column
-            top_k_idx = idx_sorted[-k:]
+            if num_non_zero > k:
+                top_k_idx = np.argpartition(column_data[non_zero_data], -k)[-k:]
+            else:
+                top_k_idx = np.arange(num_non_zero)
 
-            data.extend(column_data[non_zero_data][top_k_idx])
-            rows_indices.extend(column_row_index[non_zero_data][top_k_idx])
+            actual_k = len(top_k_idx)
 
+            data[num_cells:num_cells+actual_k] = column_data[non_zero_data][top_k_idx]
+            rows_indices[num_cells:num_cells+actual_k] = column_row_index[non_zero_data][top_k_idx]
 
-        cols_indptr.append(len(data))
+            num_cells += actual_k
+            cols_indptr[item_idx+1] = num_cells
 
-        # During testing CSR is faster
-        W_sparse = sps.csc_matrix((data, rows_indices, cols_indptr), shape=(nitems, nitems), dtype=np.float32)
+        # The top-k is selected per column, so the arrays above are CSC. Converted once here to CSR,
+        # faster during testing, since callers compute URM[user].dot(W_sparse) for every recommendation
+        W_sparse = sps.csc_matrix((data[:num_cells], rows_indices[:num_cells], cols_indptr), shape=(nitems, nitems), dtype=np.float32)
         W_sparse = W_sparse.tocsr()
 
         if verbose:
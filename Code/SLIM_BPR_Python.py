@@ -11,131 +11,64 @@ import time
 
 import numpy as np
 import scipy.sparse as sps
+from collections import defaultdict
 from scipy.special import expit
+from scipy.linalg.blas import saxpy
 
 
 
 
 
 def check_matrix(X, format='csc', dtype=np.float32):
-    if format == 'csc' and not isinstance(X, sps.csc_matrix):
-        return X.tocsc().astype(dtype)
-    elif format == 'csr' and not isinstance(X, sps.csr_matrix):
-        return X.tocsr().astype(dtype)
-    elif format == 'coo' and not isinstance(X, sps.coo_matrix):
-        return X.tocoo().astype(dtype)
-    elif format == 'dok' and not isinstance(X, sps.dok_matrix):
-        return X.todok().astype(dtype)
-    elif format == 'bsr' and not isinstance(X, sps.bsr_matrix):
-        return X.tobsr().astype(dtype)
-    elif format == 'dia' and not isinstance(X, sps.dia_matrix):
-        return X.todia().astype(dtype)
-    elif format == 'lil' and not isinstance(X, sps.lil_matrix):
-        return X.tolil().astype(dtype)
-    else:
-        return X.astype(dtype)
-
-
-
-def similarityMatrixTopK(item_weights, forceSparseOutput = True, k=100, verbose = False, inplace=True):
-    """
-    The function selects the TopK most similar elements, column-wise
-
-    :param item_weights:
-    :param forceSparseOutput:
-    :param k:
-    :param verbose:
-    :param inplace: Default True, WARNING matrix will be modified
-    :return:
-    """
-
-    assert (item_weights.shape[0] == item_weights.shape[1]), "selectTopK: ItemWeights is not a square matrix"
-
-    start_time = time.time()
-
-    if verbose:
-        print("Generating topK matrix")
-
-    nitems = item_weights.shape[1]
-    k = min(k, nitems)
-
-    # for each column, keep only the top-k scored items
-    sparse_weights = not isinstance(item_weights, np.ndarray)
-
-    if not sparse_weights:
-
-        idx_sorted = np.argsort(item_weights, axis=0)  # sort data inside each column
-
-        if inplace:
-            W = item_weights
-        else:
-            W = item_weights.copy()
-
-        # index of the items that don't belong to the top-k similar items of each column
-        not_top_k = idx_sorted[:-k, :]
-        # use numpy fancy indexing to zero-out the values in sim without using a for loop
-        W[not_top_k, np.arange(nitems)] = 0.0
-
-        if forceSparseOutput:
-            W_sparse = sps.csr_matrix(W, shape=(nitems, nitems))
-
-            if verbose:
-                print("Sparse TopK matrix generated in {:.2f} seconds".format(time.time() - start_time))
-
-            return W_sparse
-
-        if verbose:
-            print("Dense TopK matrix generated in {:.2f} seconds".format(time.time()-start_time))
-
-        return W
 
-    else:
-        # iterate over each column and keep only the top-k similar items
-        data, rows_indices, cols_indptr = [], [], []
+    # Nothing to do, avoid a full copy of the matrix
+    if sps.issparse(X) and X.format == format and X.dtype == dtype:
+        return X
 
-        item_weights = check_matrix(item_weights, format='csc', dtype=np.float32)
+    converter = {'csc': X.tocsc,
+                 'csr': X.tocsr,
+                 'coo': X.tocoo,
+                 'dok': X.todok,
+                 'bsr': X.tobsr,
+                 'dia': X.todia,
+                 'lil': X.tolil}[format]
 
-        for item_idx in range(nitems):
+    return converter().astype(dtype, copy=False)
 
-            cols_indptr.append(len(data))
 
-            start_position = item_weights.indptr[item_idx]
-            end_position = item_weights.indptr[item_idx+1]
 
-            column_data = item_weights.data[start_position:end_position]
-            column_row_index = item_weights.indices[start_position:end_position]
-
-            non_zero_data = column_data!=0
-
-            idx_sorted = np.argsort(column_data[non_zero_data])  # sort by column
-            top_k_idx = idx_sorted[-k:]
-
-            data.extend(column_data[non_zero_data][top_k_idx])
-            rows_indices.extend(column_row_index[non_zero_data][top_k_idx])
-
-
-        cols_indptr.append(len(data))
+def csr_select_rows(X, row_list):
+    """
+    Builds the CSR matrix containing the given rows of X, in the given order and with repetitions.
+    Equivalent to X[row_list,:] but gathers the indices and data directly from the CSR arrays
 
-        # During testing CSR is faster
-        W_sparse = sps.csc_matrix((data, rows_indices, cols_indptr), shape=(nitems, nitems), dtype=np.float32)
-        W_sparse = W_sparse.tocsr()
+    :param X: CSR matrix
+    :param row_list: array of row indices
+    :return: CSR matrix of shape (len(row_list), X.shape[1])
+    """
 
-        if verbose:
-            print("Sparse TopK matrix generated in {:.2f} seconds".format(time.time() - start_time))
+    row_start = X.indptr[row_list]
+    row_length = X.indptr[np.asarray(row_list)+1] - row_start
 
-        return W_sparse
+    new_indptr = np.zeros(len(row_list)+1, dtype=X.indptr.dtype)
+    np.cumsum(row_length, out=new_indptr[1:])
 
+    # Position in X.data of each cell of the new matrix
+    cell_position = np.arange(new_indptr[-1]) + np.repeat(row_start - new_indptr[:-1], row_length)
 
-def sigmoidFunction(x):
-  return 1 / (1 + np.exp(-x))
+    return sps.csr_matrix((X.data[cell_position], X.indices[cell_position], new_indptr),
+                          shape=(len(row_list), X.shape[1]))
 
 
 
 class BPR_Sampling(object):
 
-    def __init__(self):
+    def __init__(self, random_seed=None):
         super(BPR_Sampling, self).__init__()
 
+        # Single Generator shared by all the sampling methods
+        self.rng = np.random.default_rng(random_seed)
+
 
     def sampleUser(self):
         """
@@ -144,8 +77,8 @@ class BPR_Sampling(object):
         """
         while (True):
 
-            user_id = np.random.randint(0, self.n_users)
-            numSeenItems = self.URM_train[user_id].nnz
+            user_id = self.rng.integers(0, self.n_users)
+            numSeenItems = self.URM_train.indptr[user_id+1] - self.URM_train.indptr[user_id]
 
             if (numSeenItems > 0 and numSeenItems < self.n_items):
                 return user_id
@@ -158,15 +91,21 @@ class BPR_Sampling(object):
         :return: pos_item_id, neg_item_id
         """
 
-        userSeenItems = self.URM_train[user_id].indices
+        start_pos = self.URM_train.indptr[user_id]
+        end_pos = self.URM_train.indptr[user_id+1]
+
+        userSeenItems = self.URM_train.indices[start_pos:end_pos]
 
-        pos_item_id = userSeenItems[np.random.randint(0, len(userSeenItems))]
+        pos_item_id = userSeenItems[self.rng.integers(0, len(userSeenItems))]
 
         while (True):
 
-            neg_item_id = np.random.randint(0, self.n_items)
+            neg_item_id = self.rng.integers(0, self.n_items)
 
-            if (neg_item_id not in userSeenItems):
+            # userSeenItems is sorted, binary search instead of a linear scan
+            position = np.searchsorted(userSeenItems, neg_item_id)
+
+            if (position == len(userSeenItems) or userSeenItems[position] != neg_item_id):
                 return pos_item_id, neg_item_id
 
 
@@ -185,58 +124,107 @@ class BPR_Sampling(object):
     def initializeFastSampling(self, positive_threshold=3):
         print("Initializing fast sampling")
 
-        self.eligibleUsers = []
-        self.userSeenItems = dict()
+        # Select only positive interactions, filtering the CSR arrays in a single pass.
+        # URM_train has sorted indices, so the seen items of each user stay sorted
+        positive_mask = self.URM_train.data > positive_threshold
+        positive_cumsum = np.concatenate(([0], np.cumsum(positive_mask)))
+
+        # Seen items of all users stored contiguously, CSR-style
+        # The seen items of user u are seen_concat[seen_ptr[u]:seen_ptr[u+1]], sorted
+        self.seen_concat = self.URM_train.indices[positive_mask].astype(np.int32, copy=False)
+        self.seen_ptr = positive_cumsum[self.URM_train.indptr]
+        self.seen_counts = np.ediff1d(self.seen_ptr)
 
-        # Select only positive interactions
-        URM_train_positive = self.URM_train.multiply(self.URM_train>positive_threshold)
+        # Each (user, item) pair encoded as user*n_items + item, globally sorted,
+        # so that the membership test of a whole batch is a single binary search
+        self.seen_keys = np.repeat(np.arange(self.n_users, dtype=np.int64), self.seen_counts)*self.n_items + self.seen_concat
 
-        for user_id in range(self.n_users):
+        self.eligibleUsers = np.flatnonzero(self.seen_counts > 0)
 
-            if (URM_train_positive[user_id].nnz > 0):
-                self.eligibleUsers.append(user_id)
-                self.userSeenItems[user_id] = URM_train_positive[user_id].indices
 
-        self.eligibleUsers = np.array(self.eligibleUsers)
+    def isSeenItem(self, user_id_array, item_id_array):
+        """
+        Vectorized membership test of each item among the positive items of the corresponding user
+        :param user_id_array:
+        :param item_id_array:
+        :return: boolean array
+        """
 
+        sample_keys = user_id_array.astype(np.int64)*self.n_items + item_id_array
 
-    def sampleBatch(self):
-        user_id_list = np.random.choice(self.eligibleUsers, size=(self.batch_size))
-        pos_item_id_list = [None]*self.batch_size
-        neg_item_id_list = [None]*self.batch_size
+        position = np.searchsorted(self.seen_keys, sample_keys)
+        position = np.minimum(position, len(self.seen_keys)-1)
 
-        for sample_index in range(self.batch_size):
-            user_id = user_id_list[sample_index]
+        return self.seen_keys[position] == sample_keys
 
-            pos_item_id_list[sample_index] = np.random.choice(self.userSeenItems[user_id])
 
-            negItemSelected = False
+    def sampleBatch(self, num_samples=None):
+        """
+        Samples num_samples triples at once, by default a batch
+        :param num_samples:
+        :return: user_id_list, pos_item_id_list, neg_item_id_list
+        """
 
-            # It's faster to just try again then to build a mapping of the non-seen items
-            # for every user
-            while (not negItemSelected):
-                neg_item_id = np.random.randint(0, self.n_items)
+        if num_samples is None:
+            num_samples = self.batch_size
 
-                if (neg_item_id not in self.userSeenItems[user_id]):
-                    negItemSelected = True
-                    neg_item_id_list[sample_index] = neg_item_id
+        user_id_list = self.rng.choice(self.eligibleUsers, size=num_samples)
+
+        seen_start = self.seen_ptr[user_id_list]
+        seen_counts = self.seen_counts[user_id_list]
+
+        pos_item_id_list = self.seen_concat[seen_start + self.rng.integers(0, seen_counts)]
+
+        # It's faster to just try again then to build a mapping of the non-seen items
+        # for every user. All negatives are drawn at once, with sparse data almost none of them
+        # collides and only those are drawn and checked again
+        neg_item_id_list = self.rng.integers(0, self.n_items, size=num_samples)
+        to_check = np.flatnonzero(self.isSeenItem(user_id_list, neg_item_id_list))
+
+        while len(to_check) > 0:
+
+            neg_item_id_list[to_check] = self.rng.integers(0, self.n_items, size=len(to_check))
+            to_check = to_check[self.isSeenItem(user_id_list[to_check], neg_item_id_list[to_check])]
 
         return user_id_list, pos_item_id_list, neg_item_id_list
 
 
 class SLIM_BPR_Python(BPR_Sampling):
 
-    def __init__(self, URM_train, positive_threshold=3, sparse_weights = False):
-        super(SLIM_BPR_Python, self).__init__()
+    # Number of triples sampled together by epochIteration
+    SAMPLES_PER_CHUNK = 1000000
 
+    # Number of float32 rows accumulated before they are written back into a lower precision S
+    ACCUMULATOR_MAX_ROWS = 10000
 
-        self.URM_train = URM_train
+    def __init__(self, URM_train, positive_threshold=3, sparse_weights = False, random_seed = None,
+                 similarity_dtype = np.float32):
+        super(SLIM_BPR_Python, self).__init__(random_seed=random_seed)
+
+
+        # Rows are accessed per user everywhere, CSR avoids implicit conversions.
+        # Copied because check_matrix may return the caller's matrix and its indices are sorted in place
+        self.URM_train = check_matrix(URM_train.copy(), 'csr', dtype=np.float32)
+        self.URM_train.sort_indices()
         self.n_users = URM_train.shape[0]
         self.n_items = URM_train.shape[1]
         self.normalize = False
         self.sparse_weights = sparse_weights
         self.positive_threshold = positive_threshold
 
+        # S can be stored as np.float16 to halve its memory. The topK similarity is built in float32
+        # one block of rows at a time, without a float32 copy of S. Without topK, W is a view of S.
+        # The rows being trained are updated in a float32 accumulator, rebased into S every
+        # ACCUMULATOR_MAX_ROWS rows and at the end of each epoch, so that small increments add up
+        # before being rounded. Increments summing to less than half the float16 spacing during
+        # that window (about 0.004 for |S| around 8) are still lost
+        self.similarity_dtype = similarity_dtype
+
+        if np.dtype(self.similarity_dtype) == np.float32:
+            self.S_accumulator = None
+        else:
+            self.S_accumulator = dict()
+
         #self.URM_mask = self.URM_train >= self.positive_threshold
 
         self.URM_mask = self.URM_train.copy()
@@ -246,28 +234,168 @@ class SLIM_BPR_Python(BPR_Sampling):
 
 
         if self.sparse_weights:
-            self.S = sps.csr_matrix((self.n_items, self.n_items), dtype=np.float32)
+            # Only the rows touched by the training are allocated, stored as dense arrays by row index.
+            # Each epoch samples about 2*nnz items uniformly, so after the first epoch almost every row
+            # exists at full length: this saves memory only for short trainings or very large catalogs
+            self.S = defaultdict(lambda: np.zeros(self.n_items, dtype=self.similarity_dtype))
+        else:
+            self.S = np.zeros((self.n_items, self.n_items), dtype=self.similarity_dtype)
+
+
+
+
+
+
+    def getSimilarityRow(self, row_id):
+        """
+        Returns a float32 row of S that can be updated in place. With a lower precision S
+        the row is moved to the accumulator, until the next rebase
+        :param row_id:
+        :return:
+        """
+
+        if self.S_accumulator is None:
+            return self.S[row_id]
+
+        if row_id not in self.S_accumulator:
+            self.S_accumulator[row_id] = self.S[row_id].astype(np.float32)
+
+        return self.S_accumulator[row_id]
+
+
+    def rebaseSimilarity(self):
+        """
+        Writes the accumulated float32 rows back into S, rounding them to its dtype
+        :return:
+        """
+
+        for row_id, row in self.S_accumulator.items():
+            self.S[row_id][:] = row
+
+        self.S_accumulator.clear()
+
+
+    def getSimilarityRows(self, row_list):
+        """
+        Returns the rows of S as a dense float32 matrix, regardless of how S is stored
+        :param row_list:
+        :return:
+        """
+
+        if isinstance(self.S, np.ndarray) and self.S_accumulator is None:
+            return self.S[row_list]
+
+        if self.S_accumulator is None:
+            return np.vstack([self.S[row_id] for row_id in row_list])
+
+        return np.vstack([self.S_accumulator[row_id] if row_id in self.S_accumulator else self.S[row_id]
+                          for row_id in row_list]).astype(np.float32, copy=False)
+
+
+    def setSimilarityRows(self, row_list, rows):
+        """
+        Overwrites the rows of S with the given dense matrix, regardless of how S is stored
+        :param row_list:
+        :param rows:
+        :return:
+        """
+
+        if isinstance(self.S, np.ndarray):
+            self.S[row_list] = rows
+        else:
+            for row_index, row_id in enumerate(row_list):
+                self.S[row_id][:] = rows[row_index]
+
+
+    def getSimilaritySparse(self, topK=False, block_size=1000):
+        """
+        Builds the CSR matrix of S, one block of rows at a time. Only the touched rows are read
+        when S stores them alone.
+        If topK is given only the topK values of each row are kept, computed over the whole row
+        as for a dense matrix, and the other values of S are set to zero in place
+        :param topK:
+        :param block_size:
+        :return:
+        """
+
+        if isinstance(self.S, np.ndarray):
+            row_ids = np.arange(self.n_items, dtype=np.int32)
         else:
-            self.S = np.zeros((self.n_items, self.n_items)).astype('float32')
+            row_ids = np.array(sorted(self.S.keys()), dtype=np.int32)
+
+        row_length = np.zeros(self.n_items, dtype=np.int32)
+        indices_list = [np.array([], dtype=np.int32)]
+        data_list = [np.array([], dtype=np.float32)]
+
+        for block_start in range(0, len(row_ids), block_size):
+
+            block_row_ids = row_ids[block_start:block_start+block_size]
+            S_block = self.getSimilarityRows(block_row_ids).astype(np.float32, copy=False)
+
+            if topK != False and topK < self.n_items:
+                not_top_k = np.argpartition(S_block, self.n_items-topK, axis=1)[:, :self.n_items-topK]
+                np.put_along_axis(S_block, not_top_k, 0.0, axis=1)
 
+                self.setSimilarityRows(block_row_ids, S_block)
 
+            S_block = sps.csr_matrix(S_block)
 
+            row_length[block_row_ids] = np.ediff1d(S_block.indptr)
+            indices_list.append(S_block.indices)
+            data_list.append(S_block.data)
 
+        indptr = np.zeros(self.n_items+1, dtype=np.int32)
+        np.cumsum(row_length, out=indptr[1:])
+
+        return sps.csr_matrix((np.concatenate(data_list), np.concatenate(indices_list), indptr),
+                              shape=(self.n_items, self.n_items), dtype=np.float32)
 
 
     def updateSimilarityMatrix(self):
 
         if self.topK != False:
             self.sparse_weights = True
-            self.W_sparse = similarityMatrixTopK(self.S.T, k=self.topK)
+            # The topK of each column of W is the topK of each row of S, S is pruned in place
+            # in the same way for the dense and the touched rows storage
+            self.W_sparse = self.getSimilaritySparse(topK=self.topK).T.tocsr()
         else:
             if self.sparse_weights == True:
-                self.W_sparse = self.S.T
+                self.W_sparse = self.getSimilaritySparse().T
             else:
+                # A view, in the same dtype as S, to avoid a second n_items^2 matrix
                 self.W = self.S.T
 
 
 
+    def updateSimilarityRow(self, row_id, delta, alpha):
+        """
+        Adds alpha*delta to a row of S in place with BLAS saxpy, on the float32 accumulator
+        when S has a lower precision
+        :param row_id:
+        :param delta: float32 array
+        :param alpha:
+        :return:
+        """
+
+        saxpy(delta, self.getSimilarityRow(row_id), a=alpha)
+
+
+
+    def zeroSimilarityDiagonal(self, item_ids):
+        """
+        Sets S[item_id, item_id] to zero for the given items, regardless of how S is stored
+        :param item_ids: array of unique item ids
+        :return:
+        """
+
+        if isinstance(self.S, np.ndarray) and self.S_accumulator is None:
+            self.S[item_ids, item_ids] = 0.0
+        else:
+            for item_id in item_ids:
+                self.getSimilarityRow(item_id)[item_id] = 0.0
+
+
+
     def updateWeightsLoop(self, u, i, j):
         """
         Define the update rules to be used in the train phase and compile the train function
@@ -293,7 +421,7 @@ class SLIM_BPR_Python(BPR_Sampling):
 
             user_id = u[sampleIndex]
 
-            for item_id in self.userSeenItems[user_id]:
+            for item_id in self.seen_concat[self.seen_ptr[user_id]:self.seen_ptr[user_id+1]]:
                 # Do not update items i
                 if item_id != i[sampleIndex]:
                     self.S[i] += self.learning_rate * delta_i
@@ -310,10 +438,10 @@ class SLIM_BPR_Python(BPR_Sampling):
         """
 
         if self.batch_size==1:
-            seenItems = self.userSeenItems[u[0]]
+            seenItems = self.seen_concat[self.seen_ptr[u[0]]:self.seen_ptr[u[0]+1]]
 
-            x_ui = self.S[i, seenItems]
-            x_uj = self.S[j, seenItems]
+            x_ui = self.getSimilarityRow(i[0])[seenItems]
+            x_uj = self.getSimilarityRow(j[0])[seenItems]
 
             # The difference is computed on the user_seen items
             x_uij = x_ui - x_uj
@@ -322,7 +450,7 @@ class SLIM_BPR_Python(BPR_Sampling):
             x_uij = np.sum(x_uij)
 
             # log(sigm(+x_uij))
-            gradient = 1 / (1 + np.exp(x_uij))
+            gradient = expit(-x_uij)
 
             # sigm(-x_uij)
             #exp = np.exp(x_uij)
@@ -330,37 +458,54 @@ class SLIM_BPR_Python(BPR_Sampling):
 
         else:
 
-            x_ui = self.S[i]
-            x_uj = self.S[j]
+            x_ui = self.getSimilarityRows(i)
+            x_uj = self.getSimilarityRows(j)
 
             # The difference is computed on the user_seen items
             x_uij = x_ui - x_uj
 
-            x_uij = self.URM_mask[u,:].dot(x_uij.T).diagonal()
+            URM_mask_batch = csr_select_rows(self.URM_mask, u)
+
+            # Row-wise dot product of each user mask with its own sample difference,
+            # without computing the cross terms between samples
+            x_uij = np.asarray(URM_mask_batch.multiply(x_uij).sum(axis=1)).ravel()
 
-            gradient = np.sum(1 / (1 + np.exp(x_uij))) / self.batch_size
+            gradient = float(expit(-x_uij.astype(np.float32)).sum()) / self.batch_size
 
 
         if self.batch_size==1:
 
-            userSeenItems = self.userSeenItems[u[0]]
+            userSeenItems = self.seen_concat[self.seen_ptr[u[0]]:self.seen_ptr[u[0]+1]]
 
-            self.S[i, userSeenItems] += self.learning_rate * gradient
-            self.S[i, i] = 0
+            self.getSimilarityRow(i[0])[userSeenItems] += self.learning_rate * gradient
+            self.zeroSimilarityDiagonal(i)
 
-            self.S[j, userSeenItems] -= self.learning_rate * gradient
-            self.S[j, j] = 0
+            self.getSimilarityRow(j[0])[userSeenItems] -= self.learning_rate * gradient
+            self.zeroSimilarityDiagonal(j)
 
 
 
         else:
-            itemsToUpdate = np.array(self.URM_mask[u, :].sum(axis=0) > 0).ravel()
+            # Items seen by at least one user of the batch
+            itemsToUpdate = np.zeros(self.n_items, dtype=np.bool_)
+            itemsToUpdate[URM_mask_batch.indices] = True
 
             # Do not update items i, set all user-posItem to false
             # itemsToUpdate[i] = False
 
-            self.S[i] += self.learning_rate * gradient * itemsToUpdate
-            self.S[i, i] = 0
+            # The update vector is the same for all rows, computed once and applied
+            # in place on each contiguous row.
+            # A row sampled more than once receives one update per occurrence
+            delta = (gradient * itemsToUpdate).astype(np.float32)
+
+            pos_items, pos_count = np.unique(i, return_counts=True)
+            neg_items, neg_count = np.unique(j, return_counts=True)
+
+            for item_id, count in zip(pos_items, pos_count):
+                self.updateSimilarityRow(item_id, delta, self.learning_rate * count)
+
+            # The positive item is always seen by the user, a nonzero S[i,i] would bias x_uij
+            self.zeroSimilarityDiagonal(pos_items)
 
             # Now update i, setting all user-posItem to true
             # Do not update j
@@ -368,8 +513,10 @@ class SLIM_BPR_Python(BPR_Sampling):
             # itemsToUpdate[i] = True
             # itemsToUpdate[j] = False
 
-            self.S[j] -= self.learning_rate * gradient * itemsToUpdate
-            self.S[j, j] = 0
+            for item_id, count in zip(neg_items, neg_count):
+                self.updateSimilarityRow(item_id, delta, -self.learning_rate * count)
+
+            self.zeroSimilarityDiagonal(neg_items)
 
     def fit(self, epochs=30, logFile=None, URM_test=None, minRatingsPerUser=1,
             batch_size = 1000, validate_every_N_epochs = 1, start_validation_after_N_epochs = 0,
@@ -489,10 +636,24 @@ class SLIM_BPR_Python(BPR_Sampling):
 
         totalNumberOfBatch = int(numPositiveIteractions/self.batch_size)+1
 
+        # The samples of several batches are drawn at once, each batch is a slice of the chunk.
+        # The chunk size bounds the sampling memory regardless of the number of interactions
+        batchesPerChunk = max(1, int(self.SAMPLES_PER_CHUNK/self.batch_size))
+
         # Uniform user sampling without replacement
         for numCurrentBatch in range(totalNumberOfBatch):
 
-            sgd_users, sgd_pos_items, sgd_neg_items = self.sampleBatch()
+            batchInChunk = numCurrentBatch % batchesPerChunk
+
+            if batchInChunk == 0:
+                numBatchesToSample = min(batchesPerChunk, totalNumberOfBatch - numCurrentBatch)
+                chunk_users, chunk_pos_items, chunk_neg_items = self.sampleBatch(numBatchesToSample*self.batch_size)
+
+            batch_slice = slice(batchInChunk*self.batch_size, (batchInChunk+1)*self.batch_size)
+
+            sgd_users = chunk_users[batch_slice]
+            sgd_pos_items = chunk_pos_items[batch_slice]
+            sgd_neg_items = chunk_neg_items[batch_slice]
 
             self.updateWeightsBatch(
                 sgd_users,
@@ -500,6 +661,9 @@ class SLIM_BPR_Python(BPR_Sampling):
                 sgd_neg_items
                 )
 
+            if self.S_accumulator is not None and len(self.S_accumulator) >= self.ACCUMULATOR_MAX_ROWS:
+                self.rebaseSimilarity()
+
             """
             self.updateWeightsLoop(
                 sgd_users,
@@ -522,7 +686,14 @@ class SLIM_BPR_Python(BPR_Sampling):
 
 
 
-        self.S[np.arange(0, self.n_items), np.arange(0, self.n_items)] = 0.0
+        if self.S_accumulator is not None:
+            self.rebaseSimilarity()
+
+        if isinstance(self.S, np.ndarray):
+            np.fill_diagonal(self.S, 0.0)
+        else:
+            for row_id, row in self.S.items():
+                row[row_id] = 0.0
 
         self.updateSimilarityMatrix()
 
@@ -542,6 +713,46 @@ class SLIM_BPR_Python(BPR_Sampling):
         return ranking[:at]
 
 
+    def recommend_batch(self, user_id_array, at=None, exclude_seen=True):
+        """
+        Computes the recommendations of many users at once, with a single sparse product
+        :param user_id_array:
+        :param at:
+        :param exclude_seen:
+        :return: ranking, one row per user
+        """
+
+        user_id_array = np.asarray(user_id_array)
+
+        # compute the scores of all users using one sparse matrix product
+        user_profile_batch = csr_select_rows(self.URM_train, user_id_array)
+        scores_batch = user_profile_batch.dot(self.W_sparse).toarray()
+
+        if exclude_seen:
+            scores_batch = self.filter_seen_batch(user_profile_batch, scores_batch)
+
+        if at is None or at >= self.n_items:
+            return np.argsort(-scores_batch, axis=1)
+
+        # only the top-at items of each user are sorted
+        top_at = np.argpartition(-scores_batch, at-1, axis=1)[:, :at]
+        top_at_scores = np.take_along_axis(scores_batch, top_at, axis=1)
+
+        ranking = np.take_along_axis(top_at, np.argsort(-top_at_scores, axis=1), axis=1)
+
+        return ranking
+
+
+    def filter_seen_batch(self, user_profile_batch, scores_batch):
+
+        row_length = np.ediff1d(user_profile_batch.indptr)
+        row_index = np.repeat(np.arange(user_profile_batch.shape[0]), row_length)
+
+        scores_batch[row_index, user_profile_batch.indices] = -np.inf
+
+        return scores_batch
+
+
     def filter_seen(self, user_id, scores):
 
         start_pos = self.URM_train.indptr[user_id]